@@ -159,6 +159,24 @@
 #% required: no
 #% guisection: Areas to exclude
 #%end
+#%option
+#% key: max_distance
+#% type: double
+#% label: Maximum visibility distance [m]
+#% description: Viewsheds are computed within this radius from each point; the computation time grows with the square of the radius
+#% answer: 4000
+#% required: no
+#% guisection: Areas to exclude
+#%end
+#%option
+#% key: nprocs
+#% type: integer
+#% label: Number of processes to run in parallel
+#% description: With the -s flag each process runs four r.viewshed processes, so up to 4*nprocs run at the same time
+#% options: 1-
+#% answer: 1
+#% guisection: Areas to exclude
+#%end
 
 ##
 ## OUTPUTS
@@ -186,22 +204,53 @@
 #% key: c
 #% description: Clean vector lines
 #%end
+#%flag
+#% key: r
+#% description: Consider the effect of the Earth curvature and of the atmospheric refraction in the visibility computation
+#% guisection: Areas to exclude
+#%end
+#%flag
+#% key: k
+#% label: Keep the computed viewsheds and buffers and reuse them in the next runs
+#% description: They are stored as visual_cache_* rasters and buff_area_* vectors in the current mapset
+#% guisection: Areas to exclude
+#%end
+#%flag
+#% key: s
+#% label: Split each viewshed in four quadrants computed in parallel
+#% description: Useful with few points of interest on a large elevation map
+#% guisection: Areas to exclude
+#%end
+#%flag
+#% key: g
+#% label: Compute the visibility with xarray-spatial instead of r.viewshed
+#% description: The computation runs on the GPU when CuPy is installed
+#% guisection: Areas to exclude
+#%end
 
 #%rules
 #%exclusive: mfd, discharge_natural
 #%exclusive: mfd, percentage
 #%requires: discharge_natural, percentage
+#%exclusive: -g, -s
+#%exclusive: -g, -k
 #%end
 
 # import system libraries
 from __future__ import print_function
 
 import atexit
+import functools
+import hashlib
 import os
 import sys
+from collections import OrderedDict
+from multiprocessing import Pool
+
+import numpy as np
 
 from grass.pygrass.messages import get_msgr
-from grass.pygrass.vector import VectorTopo
+from grass.pygrass.modules import Module
 from grass.script import core as gcore
 # import grass libraries
 from grass.script import mapcalc
@@ -228,8 +277,21 @@ if "GISBASE" not in os.environ:
     sys.exit(1)
 
 
+REGION = {}
+
+
+def get_region(flags='pg'):
+    """Return the current region, g.region is called only when the
+    region has changed since the last call"""
+    if flags not in REGION:
+        REGION[flags] = gcore.parse_command('g.region', flags=flags)
+    return REGION[flags]
+
+
 def set_new_region(new_region):
-    gcore.run_command('g.region', res=new_region)
+    # align the region bounds to the new resolution
+    gcore.run_command('g.region', res=new_region, flags='a')
+    REGION.clear()
     return
 
 
@@ -238,9 +300,274 @@ def set_old_region(info):
                       cols=info['cols'], n=info['n'],
                       s=info['s'], w=info['w'], ewres=info['ewres'],
                       nsres=info['nsres'])
+    REGION.clear()
     return
 
 
+FINGERPRINT = {}
+
+
+def fingerprint(name, module='r.info', flags='gre'):
+    """Return a hash of the r.info (or v.info) output of a map"""
+    key = (module, flags, name)
+    if key not in FINGERPRINT:
+        info = gcore.read_command(module, flags=flags, map=name)
+        FINGERPRINT[key] = hashlib.sha1(info.encode('utf-8')).hexdigest()
+    return FINGERPRINT[key]
+
+
+def cached(func):
+    """Decorate a function func(vshed, out, coords) that computes a
+    viewshed, in order to store its result in the current mapset and to
+    copy it instead of computing it again when the point, the elevation,
+    the region and the r.viewshed parameters are the same"""
+    @functools.wraps(func)
+    def wrapper(vshed, out, coords):
+        key = repr((float(coords[0]).hex(), float(coords[1]).hex(),
+                    fingerprint(vshed.inputs.input),
+                    sorted(get_region().items()),
+                    float(vshed.inputs.max_distance).hex(),
+                    vshed.flags['c'].value, vshed.flags['r'].value))
+        name = 'visual_cache_%s' % hashlib.sha1(key.encode('utf-8')).hexdigest()
+        if gcore.find_file(name, element='cell', mapset='.')['name']:
+            gcore.run_command('g.copy', raster=(name, out), overwrite=True,
+                              quiet=True)
+            return out
+        func(vshed, out, coords)
+        gcore.run_command('g.copy', raster=(out, name), overwrite=True,
+                          quiet=True)
+        return out
+    return wrapper
+
+
+def viewshed(vshed, out, coords):
+    """Compute the boolean viewshed of a single observer point with the
+    r.viewshed Module object vshed"""
+    vshed.outputs.output = out
+    vshed.inputs.coordinates = coords
+    vshed.run()
+    return out
+
+
+def quadrant_viewshed(vshed, out, coords):
+    """Compute the viewshed of a single observer point as four quadrants
+    around the point, each one with its own r.viewshed process.
+
+    The line of sight from the point to any cell of a quadrant lies inside
+    the quadrant, so patching the quadrants gives the same viewshed of a
+    single r.viewshed run.
+    """
+    reg = get_region()
+    nsres, ewres = float(reg['nsres']), float(reg['ewres'])
+    x, y = coords
+    dist = float(vshed.inputs.max_distance)
+    if dist < 0:
+        dist = float('inf')
+    north = min(float(reg['n']), y + dist)
+    south = max(float(reg['s']), y - dist)
+    east = min(float(reg['e']), x + dist)
+    west = max(float(reg['w']), x - dist)
+    # overlap the quadrants by one cell to keep the point inside all of them
+    bounds = [(north, y - nsres, east, x - ewres),
+              (north, y - nsres, x + ewres, west),
+              (y + nsres, south, x + ewres, west),
+              (y + nsres, south, east, x - ewres)]
+    vflags = ''.join([flg for flg in 'bcr' if vshed.flags[flg].value])
+    memory = max(int(vshed.inputs.memory) // 4, 1)
+    quads, procs = [], []
+    try:
+        for i, (qn, qs, qe, qw) in enumerate(bounds):
+            qn, qs = min(qn, north), max(qs, south)
+            qe, qw = min(qe, east), max(qw, west)
+            if qn <= qs or qe <= qw:
+                continue
+            quad = '%s_q%d' % (out, i)
+            env = gcore.region_env(n=qn, s=qs, e=qe, w=qw, nsres=nsres,
+                                   ewres=ewres, flags='a')
+            procs.append(gcore.start_command(
+                'r.viewshed', input=vshed.inputs.input, output=quad,
+                coordinates=coords, memory=memory, flags=vflags,
+                max_distance=vshed.inputs.max_distance, overwrite=True,
+                quiet=True, env=env))
+            quads.append(quad)
+        # wait for all the processes before checking the results
+        failed = [proc for proc in procs if proc.wait()]
+        if failed:
+            # do not use gcore.fatal, it exits and hangs the Pool
+            raise RuntimeError('r.viewshed failed for the point %f,%f'
+                               % coords)
+        gcore.run_command('r.mapcalc', overwrite=True,
+                          expression='%s = int(nmax(%s, 0))' % (
+                              out, ','.join(quads)))
+    finally:
+        for proc in procs:
+            proc.wait()
+        gcore.run_command('g.remove', flags='f', type='raster',
+                          pattern='%s_q*' % out, quiet=True)
+    return out
+
+
+def cumulative_viewshed(args):
+    """Sum the viewsheds of a group of points into the acc raster.
+
+    The points are (coordinates, weight) pairs, the viewshed of each point
+    is computed once and added weight times. The viewsheds are added one
+    at a time, so that no more than three rasters of the group exist at
+    the same time.
+    """
+    dtm, points, acc, memory, max_distance, vflags, cache, split = args
+    vis = '%s_vis' % acc
+    tmp = '%s_tmp' % acc
+    compute = quadrant_viewshed if split else viewshed
+    if cache:
+        compute = cached(compute)
+    # build the modules once and run them for each point
+    vshed = Module('r.viewshed', input=dtm, memory=memory, flags=vflags,
+                   max_distance=max_distance, overwrite=True, run_=False)
+    add = Module('r.mapcalc', expression='%s = int(%s + %s)' % (tmp, acc, vis),
+                 overwrite=True, run_=False)
+    scale = Module('r.mapcalc', overwrite=True, run_=False)
+    remove = Module('g.remove', flags='f', type='raster', name=vis,
+                    quiet=True, run_=False)
+    rename = Module('g.rename', raster=(tmp, acc), overwrite=True,
+                    quiet=True, run_=False)
+    try:
+        coords, weight = points[0]
+        compute(vshed, acc, coords)
+        if weight > 1:
+            scale.inputs.expression = '%s = int(%d * %s)' % (tmp, weight, acc)
+            scale.run()
+            rename.run()
+        for coords, weight in points[1:]:
+            compute(vshed, vis, coords)
+            if weight > 1:
+                scale.inputs.expression = '%s = int(%s + %d * %s)' % (
+                    tmp, acc, weight, vis)
+                scale.run()
+            else:
+                add.run()
+            remove.run()
+            rename.run()
+    except Exception as exc:
+        # the GRASS exceptions may not be unpickled by the Pool, send back
+        # a plain one
+        raise RuntimeError(str(exc))
+    finally:
+        # remove the intermediate maps also when a point fails, acc is
+        # removed by the main process
+        gcore.run_command('g.remove', flags='f', type='raster',
+                          pattern='%s_*' % acc, quiet=True)
+    return acc
+
+
+def sum_rasters(inputs, output, tmprast, ovw, chunk=32):
+    """Sum the CELL input rasters with r.mapcalc, adding at most chunk
+    rasters in each expression"""
+    level = 0
+    while len(inputs) > chunk:
+        partials = []
+        for i in range(0, len(inputs), chunk):
+            partial = '%s_part_%d_%03d' % (output, level, i // chunk)
+            mapcalc('%s = int(%s)' % (partial, '+'.join(inputs[i:i + chunk])),
+                    overwrite=True)
+            tmprast.append(partial)
+            partials.append(partial)
+        inputs = partials
+        level += 1
+    mapcalc('%s = int(%s)' % (output, '+'.join(inputs)), overwrite=ovw)
+    return output
+
+
+def overlap_bbox(vect_a, vect_b, buff=0.):
+    """Return True if the bounding boxes of the two vectors overlap,
+    the bounding box of vect_b is enlarged by buff"""
+    a = gcore.parse_command('v.info', flags='g', map=vect_a)
+    b = gcore.parse_command('v.info', flags='g', map=vect_b)
+    return not (float(a['west']) > float(b['east']) + buff or
+                float(a['east']) < float(b['west']) - buff or
+                float(a['south']) > float(b['north']) + buff or
+                float(a['north']) < float(b['south']) - buff)
+
+
+def clip_areas(river, area, output, tmpvect, ovw):
+    """Remove the areas from the river with v.overlay, keeping the category
+    of the original river segment on each clipped piece"""
+    clip = '%s_clip' % output
+    gcore.run_command('v.overlay', ainput=river, binput=area,
+                      operator='not', output=clip, overwrite=ovw)
+    tmpvect.append(clip)
+    gcore.run_command('v.reclass', input=clip, column='a_cat',
+                      output=output, overwrite=ovw)
+    return output
+
+
+def exclude_areas(river, area, output, tmpvect, ovw):
+    """Remove from the river the segments that fall inside the areas.
+
+    Only the river segments that overlap the areas are clipped with
+    v.overlay, the remaining segments are patched back unchanged. All the
+    pieces keep the category of the original segment.
+    """
+    sel = '%s_sel' % output
+    rest = '%s_rest' % output
+    # -c keeps the features without category, as v.overlay does
+    gcore.run_command('v.select', flags='tc', ainput=river, binput=area,
+                      output=sel, operator='overlap', overwrite=ovw)
+    tmpvect.append(sel)
+    if not gcore.vector_info_topo(sel)['lines']:
+        # nothing to clip
+        gcore.run_command('g.copy', vector=(river, output), overwrite=ovw)
+        return output
+    gcore.run_command('v.select', flags='trc', ainput=river, binput=area,
+                      output=rest, operator='overlap', overwrite=ovw)
+    tmpvect.append(rest)
+    if not gcore.vector_info_topo(rest)['lines']:
+        return clip_areas(sel, area, output, tmpvect, ovw)
+    clip = clip_areas(sel, area, '%s_cats' % output, tmpvect, ovw)
+    tmpvect.append(clip)
+    gcore.run_command('v.patch', input=(clip, rest), output=output,
+                      overwrite=ovw)
+    return output
+
+
+def xrs_cumulative_viewshed(dtm, coords, output, max_distance):
+    """Sum the viewsheds of the points into the output raster using
+    xarray-spatial, on the GPU if CuPy is available"""
+    try:
+        import xarray as xr
+        import xrspatial
+    except ImportError:
+        gcore.fatal('You should install xarray and xarray-spatial to use '
+                    'the -g flag: pip install xarray-spatial')
+    try:
+        import cupy as xp
+    except ImportError:
+        xp = np
+    from grass.script import array as garray
+
+    reg = get_region()
+    elev = garray.array(mapname=dtm)
+    rows, cols = elev.shape
+    xs = float(reg['w']) + (np.arange(cols) + 0.5) * float(reg['ewres'])
+    ys = float(reg['n']) - (np.arange(rows) + 0.5) * float(reg['nsres'])
+    raster = xr.DataArray(xp.asarray(elev), coords={'y': ys, 'x': xs},
+                          dims=('y', 'x'))
+    xx, yy = np.meshgrid(xs, ys)
+    total = garray.array(dtype=np.int32)
+    for x, y in coords:
+        vis = xrspatial.viewshed(raster, x=x, y=y, observer_elev=1.75)
+        # invisible cells have a negative value
+        visible = vis.data >= 0
+        if xp is not np:
+            visible = xp.asnumpy(visible)
+        # a negative distance means no limit, as for r.viewshed
+        if max_distance >= 0:
+            visible &= (xx - x) ** 2 + (yy - y) ** 2 <= max_distance ** 2
+        total += visible
+    total.write(mapname=output, overwrite=True)
+    return output
+
+
 def main(opts, flgs):
     TMPRAST, TMPVECT, DEBUG = [], [], flgs['d']
     atexit.register(cleanup, raster=TMPRAST, vector=TMPVECT, debug=DEBUG)
@@ -265,18 +592,39 @@ def main(opts, flgs):
     n_points = options['n_points']
     p_min = options['p_min']
     percentage = options['percentage']
+    nprocs = int(options['nprocs'])
+    max_distance = float(options['max_distance'])
+    # r.viewshed computes the refraction only together with the curvature
+    vflags = 'bcr' if flags['r'] else 'b'
     msgr = get_msgr()
 
     # set the region
-    info = gcore.parse_command('g.region', flags='m')
+    info = get_region()
     if (info['nsres'] == 0) or (info['ewres'] == 0):
         msgr.warning("set region to elevation raster")
         gcore.run_command('g.region', raster=dtm)
+        REGION.clear()
 
     pid = os.getpid()
 
-    if area:
-        if float(buff):
+    if area and not overlap_bbox(river, area, abs(float(buff))):
+        msgr.message("The areas to exclude do not overlap the river, "
+                     "skip the exclusion")
+    elif area:
+        if float(buff) and flags['k']:
+            # reuse the buffer computed by a previous run
+            key = repr((fingerprint(area, module='v.info', flags=''),
+                        float(buff).hex()))
+            area_buff = 'buff_area_%s' % hashlib.sha1(
+                key.encode('utf-8')).hexdigest()
+            if not gcore.find_file(area_buff, element='vector',
+                                   mapset='.')['name']:
+                gcore.run_command('v.buffer',
+                                  input=area,
+                                  output=area_buff,
+                                  distance=buff, overwrite=True)
+            area = area_buff
+        elif float(buff):
             area_tmp = 'tmp_buff_area_%05d' % pid
             gcore.run_command('v.buffer',
                               input=area,
@@ -285,73 +633,107 @@ def main(opts, flgs):
             area = area_tmp
             TMPVECT.append(area)
         oriver = 'tmp_river_%05d' % pid
-        gcore.run_command('v.overlay', flags='t',
-                          ainput=river,
-                          binput=area,
-                          operator='not',
-                          output=oriver, overwrite=OVW)
-        river = oriver
+        river = exclude_areas(river, area, oriver, TMPVECT, OVW)
         TMPVECT.append(oriver)
 
     if points_view:
-        info_old = gcore.parse_command('g.region', flags='pg')
+        info_old = get_region()
         set_new_region(new_region)
-        pl, mset = points_view.split('@') if '@' in points_view else (points_view, '')
-        vec = VectorTopo(pl, mapset=mset, mode='r')
-        vec.open("r")
-        string = '0'
-        for i, point in enumerate(vec):
-            out = 'tmp_visual_%05d_%03d' % (pid, i)
-            gcore.run_command('r.viewshed', input=dtm, output=out,
-                              coordinates=point.coords(), overwrite=OVW,
-                              memory=1000, flags='b', max_distance=4000,
-                              )
-            TMPRAST.append(out)
-            # we use 4 km sice it the human limit
-            string = string + ('+%s' % out)
-        #import pdb; pdb.set_trace()
-
+        # read all the point coordinates at once
+        coords = np.loadtxt(gcore.read_command('v.out.ascii',
+                                               input=points_view,
+                                               format='point',
+                                               separator=',').splitlines(),
+                            delimiter=',', usecols=(0, 1),
+                            ndmin=2).reshape(-1, 2)
         tmp_final_vis = 'tmp_final_vis_%05d' % pid
-        formula = '%s = %s' % (tmp_final_vis, string)
         TMPRAST.append(tmp_final_vis)
-        mapcalc(formula, overwrite=OVW)
+        if not len(coords):
+            msgr.warning("No points of interest in <%s>" % points_view)
+            mapcalc('%s = 0' % tmp_final_vis, overwrite=OVW)
+        elif flags['g']:
+            if flags['r']:
+                msgr.warning("refraction is not supported with the -g flag")
+            if nprocs > 1:
+                msgr.warning("the -g flag runs in a single process, "
+                             "nprocs is ignored")
+            xrs_cumulative_viewshed(dtm, coords, tmp_final_vis,
+                                    max_distance)
+        else:
+            # split the memory among the parallel r.viewshed processes
+            memory = max(1000 // nprocs, 1)
+            # compute the viewshed of repeated points only once, so that
+            # two processes never compute (and cache) the same viewshed
+            weights = OrderedDict()
+            for x, y in coords:
+                point = (float(x), float(y))
+                weights[point] = weights.get(point, 0) + 1
+            points = list(weights.items())
+            # each process accumulates the viewsheds of a group of points
+            jobs = []
+            for i in range(min(nprocs, len(points))):
+                acc = 'tmp_visual_%05d_%03d' % (pid, i)
+                jobs.append((dtm, points[i::nprocs], acc, memory,
+                             max_distance, vflags, flags['k'],
+                             flags['s']))
+                TMPRAST.append(acc)
+            if len(jobs) == 1:
+                # no need of other processes
+                outs = [cumulative_viewshed(jobs[0])]
+            else:
+                pool = Pool(len(jobs))
+                outs = pool.map(cumulative_viewshed, jobs)
+                pool.close()
+                pool.join()
+            #import pdb; pdb.set_trace()
+
+            if len(outs) == 1:
+                # the partial sum is already the CELL count of the viewsheds
+                gcore.run_command('g.rename', raster=(outs[0], tmp_final_vis),
+                                  overwrite=OVW, quiet=True)
+                TMPRAST.remove(outs[0])
+            else:
+                # sum the partial sums of the processes as CELL, r.series
+                # would write a DCELL map
+                sum_rasters(outs, tmp_final_vis, TMPRAST, OVW)
+        # keep only the cells viewed by at least n_points points
+        # before the vectorization
+        min_points = max(int(n_points) if n_points else 0, 1)
+        tmp_thr_vis = 'tmp_thr_vis_%05d' % pid
+        TMPRAST.append(tmp_thr_vis)
+        mapcalc('%s = if(%s >= %d, %s, null())' % (tmp_thr_vis, tmp_final_vis,
+                                                   min_points, tmp_final_vis),
+                overwrite=OVW)
         # change to old region
         set_old_region(info_old)
-        TMPVECT.append(tmp_final_vis)
         gcore.run_command('r.to.vect', flags='v', overwrite=OVW,
-                          input=tmp_final_vis, output=tmp_final_vis,
+                          input=tmp_thr_vis, output=final_vis,
                           type='area')
-        if int(n_points) > 0:
-            where = 'cat<%s' % (n_points)
+        if overlap_bbox(river, final_vis):
+            tmp_river = 'tmp_river2_%05d' % pid
+            river = exclude_areas(river, final_vis, tmp_river, TMPVECT, OVW)
+            TMPVECT.append(tmp_river)
         else:
-            where = 'cat=0'
-        gcore.run_command('v.db.droprow', input=tmp_final_vis,
-                          where=where, output=final_vis, overwrite=OVW)
-        tmp_river = 'tmp_river2_%05d' % pid
-        gcore.run_command('v.overlay', flags='t',
-                          ainput=river,
-                          binput=final_vis,
-                          operator='not',
-                          output=tmp_river, overwrite=OVW)
-        river = tmp_river
-        TMPVECT.append(tmp_river)
+            msgr.message("The viewed areas do not overlap the river, "
+                         "skip the exclusion")
 
         #import pdb; pdb.set_trace()
 
     tmp_disch = 'tmp_discharge_%05d' % pid
+    # r.green.hydro.optimal accepts only one discharge map, compute it in
+    # a single pass as FCELL
     if mfd:
-        formula = '%s=%s-%s' % (tmp_disch, discharge_current, mfd)
+        formula = '%s=float(%s-%s)' % (tmp_disch, discharge_current, mfd)
         mapcalc(formula, overwrite=OVW)
         TMPRAST.append(tmp_disch)
         discharge_current = tmp_disch
 
     elif discharge_natural:
-        formula = '%s=%s-%s*%s/100.0' % (tmp_disch, discharge_current,
-                                         discharge_natural,
-                                         percentage)
+        formula = '%s=float(max(%s-%s*%s/100.0, 0))' % (tmp_disch,
+                                                       discharge_current,
+                                                       discharge_natural,
+                                                       percentage)
         mapcalc(formula, overwrite=OVW)
-        formula = '%s=if(%s>0, %s, 0)' % (tmp_disch, tmp_disch, tmp_disch)
-        mapcalc(formula, overwrite=True)
         TMPRAST.append(tmp_disch)
         discharge_current = tmp_disch
 
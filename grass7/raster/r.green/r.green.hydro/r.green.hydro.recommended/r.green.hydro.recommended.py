@@ -297,7 +297,7 @@ def main(opts, flgs):
         pl, mset = points_view.split('@') if '@' in points_view else (points_view, '')
         vec = VectorTopo(pl, mapset=mset, mode='r')
         vec.open("r")
-        string = '0'
+        outs = []
         for i, point in enumerate(vec):
             out = 'tmp_visual_%05d_%03d' % (pid, i)
             gcore.run_command('r.viewshed', input=dtm, output=out,
@@ -306,11 +306,11 @@ def main(opts, flgs):
                               )
             TMPRAST.append(out)
             # we use 4 km sice it the human limit
-            string = string + ('+%s' % out)
+            outs.append(out)
         #import pdb; pdb.set_trace()
 
         tmp_final_vis = 'tmp_final_vis_%05d' % pid
-        formula = '%s = %s' % (tmp_final_vis, string)
+        formula = '%s = int(%s)' % (tmp_final_vis, '+'.join(outs) or '0')
         TMPRAST.append(tmp_final_vis)
         mapcalc(formula, overwrite=OVW)
         # change to old region